@@ -1,11 +1,14 @@
 print("Starting api.py")
-from fastapi import FastAPI, HTTPException, Depends, status, Query
+from fastapi import FastAPI, HTTPException, Depends, status, Query, File, Form, UploadFile
 from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Optional
 import chromadb
+from chromadb.utils import embedding_functions
 import os
 from dotenv import load_dotenv
 import logging
@@ -16,8 +19,18 @@ from jose import JWTError, jwt
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
 from database import User as DBUser, get_db  # Make sure this import is correct
+from chunk_schema import book_outline, chunk_labels
+from scheduler import AdmissionController, Overloaded, SingleFlight
+from snapshot import PartialRestore, SnapshotConflict, export_snapshot, restore_snapshot
 
 import asyncio
+import base64
+import html
+import json
+import re
+import shutil
+import tarfile
+import tempfile
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -41,7 +54,9 @@ app.add_middleware(
 # ChromaDB setup
 CHROMA_PATH = os.path.join("chroma_db")
 chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
-collection = chroma_client.get_or_create_collection(name="books")
+# Chroma's default model, made explicit so /search can embed queries once and reuse them
+embedding_function = embedding_functions.DefaultEmbeddingFunction()
+collection = chroma_client.get_or_create_collection(name="books", embedding_function=embedding_function)
 
 # OpenAI setup
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -166,6 +181,32 @@ class ChatRequest(BaseModel):
     user_id: str
     book_id: str
     messages: List[ChatMessage]
+    # Optional chapter scoping; chapter numbers are the indexes from /books/{book_id}/chapters
+    chapter: Optional[int] = None
+    chapter_start: Optional[int] = None
+    chapter_end: Optional[int] = None
+    chapter_title: Optional[str] = None
+
+class Chapter(BaseModel):
+    index: int
+    title: str
+
+# Number of chunks retrieved for whole-book and chapter-scoped questions
+CHAT_N_RESULTS = 10
+SCOPED_CHAT_N_RESULTS = 6
+
+# Admission control for /chat: concurrent streams overall and per user, queue sizes,
+# and how long a request may wait for a slot before it is shed
+chat_admission = AdmissionController(
+    "chat",
+    max_concurrent=int(os.getenv("CHAT_MAX_CONCURRENT", 16)),
+    max_per_user=int(os.getenv("CHAT_MAX_PER_USER", 2)),
+    max_queue=int(os.getenv("CHAT_MAX_QUEUE", 64)),
+    max_queue_per_user=int(os.getenv("CHAT_MAX_QUEUE_PER_USER", 4)),
+    max_wait=float(os.getenv("CHAT_MAX_WAIT", 20)),
+    retry_after=int(os.getenv("CHAT_RETRY_AFTER", 5)),
+)
+retrieval_flights = SingleFlight()
 
 # Define a new Pydantic model for the book response
 class BookResponse(BaseModel):
@@ -256,11 +297,93 @@ async def delete_book(book_id: str, current_user: DBUser = Depends(get_current_a
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
-@app.post("/chat")
-async def chat(request: ChatRequest, current_user: DBUser = Depends(get_current_active_user)):
-    user_id = str(current_user.id)
+def match_chapter_title(chapter_title: str, chapters: List[str]):
+    """Find the chapters a title refers to, preferring the tightest kind of match.
+
+    Tries an exact (case-insensitive) title, then the title as whole words ("Chapter 1"
+    but not "Chapter 10"), then a plain substring. Matches must be consecutive chapters;
+    anything else is ambiguous and reported back instead of searching everything between.
+    """
+    needle = chapter_title.strip().lower()
+    word_pattern = re.compile(rf"(?<!\w){re.escape(needle)}(?!\w)")
+    for matches_title in (
+        lambda title: title.strip().lower() == needle,
+        lambda title: word_pattern.search(title.lower()) is not None,
+        lambda title: needle in title.lower(),
+    ):
+        matches = [i for i, title in enumerate(chapters, start=1) if matches_title(title)]
+        if matches:
+            break
+    else:
+        raise HTTPException(status_code=404, detail=f"No chapter matching '{chapter_title}'")
+
+    if matches != list(range(matches[0], matches[-1] + 1)):
+        options = "; ".join(f"{i}: {chapters[i - 1]}" for i in matches)
+        raise HTTPException(status_code=400, detail=f"'{chapter_title}' matches several chapters ({options}); pick one by number")
+    return matches[0], matches[-1]
+
+def resolve_chapter_range(request: ChatRequest, chapters: List[str]):
+    """Turn the chapter scoping fields of a chat request into an inclusive (start, end) range."""
+    if request.chapter is None and request.chapter_start is None and request.chapter_end is None and not request.chapter_title:
+        return None
+    if not chapters:
+        raise HTTPException(status_code=400, detail="Book has no chapter information; re-upload it to enable chapter scoping")
+
+    if request.chapter_title:
+        start, end = match_chapter_title(request.chapter_title, chapters)
+    elif request.chapter is not None:
+        start = end = request.chapter
+    else:
+        start = request.chapter_start if request.chapter_start is not None else 1
+        end = request.chapter_end if request.chapter_end is not None else len(chapters)
+
+    if start < 1 or end > len(chapters) or start > end:
+        raise HTTPException(status_code=400, detail=f"Chapter range must be within 1-{len(chapters)}")
+    return start, end
+
+def passage_label(metadata: dict, chapters: List[str], sections: List[str]):
+    labels = [label for label in chunk_labels(metadata, chapters, sections) if label]
+    return " / ".join(labels) or "Passage"
+
+@app.get("/books/{book_id}/chapters", response_model=List[Chapter])
+async def list_chapters(book_id: str, current_user: DBUser = Depends(get_current_active_user)):
+    results = await run_in_threadpool(
+        collection.get,
+        ids=[book_id],
+        where={"$and": [{"type": "book_metadata"}, {"user_id": str(current_user.id)}]},
+        include=["metadatas"]
+    )
+    if not results['ids']:
+        raise HTTPException(status_code=404, detail="Book not found")
+    chapters, _ = book_outline(results['metadatas'][0])
+    return [Chapter(index=i, title=title) for i, title in enumerate(chapters, start=1)]
+
+async def admit(controller: AdmissionController, user_id: str):
+    """Wait for a slot on `controller`; returns an idempotent release callback."""
+    try:
+        await controller.acquire(user_id)
+    except Overloaded as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    released = False
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            controller.release(user_id)
+    return release
+
+async def retrieve_passages(user_id: str, book_id: str, question: str, where_clause: dict, n_results: int):
+    # Identical questions about the same book that are already in flight share one query
+    key = (user_id, book_id, question, json.dumps(where_clause, sort_keys=True), n_results)
+    return await retrieval_flights.do(key, lambda: run_in_threadpool(
+        collection.query, query_texts=[question], where=where_clause, n_results=n_results
+    ))
+
+async def build_chat_messages(request: ChatRequest, user_id: str):
     # Retrieve book metadata
-    book_metadata = collection.get(
+    book_metadata = await run_in_threadpool(
+        collection.get,
         ids=[request.book_id],
         where={"user_id": user_id}
     )
@@ -270,24 +393,46 @@ async def chat(request: ChatRequest, current_user: DBUser = Depends(get_current_
     
     book_title = book_metadata['metadatas'][0].get('title', 'Unknown Title')
     book_description = book_metadata['metadatas'][0].get('description', 'No description available')
+    chapters, sections = book_outline(book_metadata['metadatas'][0])
+
+    where_clause = {"$and": [{"user_id": user_id}, {"book_id": request.book_id}]}
+    chapter_range = resolve_chapter_range(request, chapters)
+    if chapter_range:
+        where_clause["$and"] += [
+            {"chapter_index": {"$gte": chapter_range[0]}},
+            {"chapter_index": {"$lte": chapter_range[1]}}
+        ]
     
     # Query for relevant content based on the last user message
     last_user_message = next((m.content for m in reversed(request.messages) if m.role == "user"), "")
-    results = collection.query(
-        query_texts=[last_user_message],
-        where={"$and": [{"user_id": user_id}, {"book_id": request.book_id}]},
-        n_results=10
+    results = await retrieve_passages(
+        user_id, request.book_id, last_user_message, where_clause,
+        SCOPED_CHAT_N_RESULTS if chapter_range else CHAT_N_RESULTS
     )
 
+    # Present the passages in reading order, labelled with where they come from
+    passages = sorted(
+        zip(results['documents'][0], results['metadatas'][0]),
+        key=lambda passage: passage[1].get('chunk_index', 0)
+    )
+    relevant_content = "\n\n".join(
+        f"[{passage_label(metadata, chapters, sections)}]\n{document}" for document, metadata in passages
+    )
+
+    scope = ""
+    if chapter_range:
+        scope_titles = ", ".join(chapters[chapter_range[0] - 1:chapter_range[1]])
+        scope = f"\nThe user is asking about this part of the book: {scope_titles}\n"
+
     system_prompt = f"""
 
 You are an expert on the book titled "{book_title}". Answer the user's questions using only the information provided below. Do not use any outside knowledge. If the answer is not in the provided content, respond with "That information is not available in the book."
-
+{scope}
 **Book Description:**
 {book_description}
 
 **Relevant Content:**
-{str(results['documents'])}
+{relevant_content}
 
 **Example Question and Answer:**
 
@@ -297,24 +442,328 @@ You are an expert on the book titled "{book_title}". Answer the user's questions
 Use this format to answer the user's questions.
     """
     
-    messages = [{"role": "system", "content": system_prompt}] + [m.dict() for m in request.messages]
+    return [{"role": "system", "content": system_prompt}] + [m.dict() for m in request.messages]
+
+@app.post("/chat")
+async def chat(request: ChatRequest, current_user: DBUser = Depends(get_current_active_user)):
+    user_id = str(current_user.id)
+    # The slot is held until the answer has finished streaming
+    release = await admit(chat_admission, user_id)
+    try:
+        messages = await build_chat_messages(request, user_id)
+    except BaseException:
+        release()
+        raise
     
     async def event_generator():
-        # Use the asynchronous version of the API call
-        stream = await openai.ChatCompletion.acreate(
-            model="gpt-4o-mini",  # or another valid model ID
-            messages=messages,
-            stream=True,
-            temperature=0.2
+        try:
+            # Use the asynchronous version of the API call
+            stream = await openai.ChatCompletion.acreate(
+                model="gpt-4o-mini",  # or another valid model ID
+                messages=messages,
+                stream=True,
+                temperature=0.2
+            )
+            async for chunk in stream:  # This should work now
+                if chunk.get("choices") and chunk["choices"][0].get("delta"):
+                    content = chunk["choices"][0]["delta"].get("content")
+                    if content is not None:
+                        yield f"data: {content}\n\n"
+            yield "data: [DONE]\n\n"
+        finally:
+            release()
+
+    # The background task also releases the slot if the client goes away before streaming starts
+    return StreamingResponse(event_generator(), media_type="text/event-stream", background=BackgroundTask(release))
+
+class SearchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=10)
+    per_book: int = Field(3, ge=1, le=10)  # Passages returned for each book
+    limit: int = Field(10, ge=1, le=50)  # Passages per page of the overall ranking
+    cursor: Optional[str] = None
+    book_ids: Optional[List[str]] = None  # Restrict the search to these books
+    max_books: int = Field(10, ge=1, le=50)  # Books returned in the per-book ranking
+
+class SearchHit(BaseModel):
+    chunk_id: str
+    book_id: str
+    title: str
+    chapter: str
+    section: str
+    chunk_index: int
+    distance: float
+    snippet: str
+
+class BookHits(BaseModel):
+    book_id: str
+    title: str
+    creator: str
+    cover_url: str
+    best_distance: float
+    passages: List[SearchHit]
+
+class QueryResults(BaseModel):
+    query: str
+    # Per-book ranking; only sent on the first page, the cursor pages `passages`
+    books: Optional[List[BookHits]] = None
+    passages: List[SearchHit]
+
+class SearchResponse(BaseModel):
+    results: List[QueryResults]
+    next_cursor: Optional[str] = None
+
+# Depth of the overall ranking a cursor can page through; on the first page it is
+# also the candidate pool the per-book ranking picks its books from
+SEARCH_MAX_CANDIDATES = 200
+# Most per-book searches a single request may run
+SEARCH_MAX_BOOK_PASSES = int(os.getenv("SEARCH_MAX_BOOK_PASSES", 30))
+SNIPPET_LENGTH = 240
+
+search_admission = AdmissionController(
+    "search",
+    max_concurrent=int(os.getenv("SEARCH_MAX_CONCURRENT", 16)),
+    max_per_user=int(os.getenv("SEARCH_MAX_PER_USER", 4)),
+    max_queue=int(os.getenv("SEARCH_MAX_QUEUE", 64)),
+    max_queue_per_user=int(os.getenv("SEARCH_MAX_QUEUE_PER_USER", 8)),
+    max_wait=float(os.getenv("SEARCH_MAX_WAIT", 10)),
+    retry_after=int(os.getenv("SEARCH_RETRY_AFTER", 2)),
+)
+
+def encode_cursor(offset: int):
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+def decode_cursor(cursor: Optional[str]):
+    if not cursor:
+        return 0
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))["offset"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(offset, int) or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return offset
+
+def highlight_snippet(text: str, query: str, length: int = SNIPPET_LENGTH):
+    """Cut a window of `text` around the first query term and wrap the terms in <mark>."""
+    terms = sorted({term for term in re.findall(r"\w+", query.lower()) if len(term) > 2}, key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE) if terms else None
+
+    match = pattern.search(text) if pattern else None
+    start = max(0, match.start() - length // 3) if match else 0
+    end = min(len(text), start + length)
+    window = text[start:end]
+
+    parts = []
+    last = 0
+    for term_match in (pattern.finditer(window) if pattern else ()):
+        parts.append(html.escape(window[last:term_match.start()]))
+        parts.append(f"<mark>{html.escape(term_match.group())}</mark>")
+        last = term_match.end()
+    parts.append(html.escape(window[last:]))
+
+    snippet = "".join(parts)
+    if start > 0:
+        snippet = "…" + snippet
+    if end < len(text):
+        snippet = snippet + "…"
+    return snippet
+
+def candidate_books(overall, max_books: int):
+    """Books of the overall candidate pool worth a per-book pass, best first.
+
+    Takes the first `max_books` distinct books of each query's pool, interleaved
+    across queries so every query gets its top books in before the cap applies.
+    """
+    ranked = []
+    for metadatas in overall['metadatas']:
+        query_books = []
+        for metadata in metadatas:
+            if metadata['book_id'] not in query_books:
+                query_books.append(metadata['book_id'])
+        ranked.append(query_books[:max_books])
+
+    candidates = []
+    for rank in range(max_books):
+        for query_books in ranked:
+            if rank < len(query_books) and query_books[rank] not in candidates:
+                candidates.append(query_books[rank])
+    return candidates[:SEARCH_MAX_BOOK_PASSES]
+
+def run_search(request: SearchRequest, user_id: str, n_results: int, rank_books: bool):
+    """Run the overall search and, when `rank_books` is set, a per-book pass.
+
+    The per-book pass is bounded: the overall search goes SEARCH_MAX_CANDIDATES deep,
+    and only books found in that pool get their own search, at most
+    SEARCH_MAX_BOOK_PASSES of them. A book with no passage in the pool is left out
+    of the per-book ranking.
+    """
+    include = ["documents", "metadatas", "distances"]
+    # Embed every query once, in one batch; all the searches below reuse the vectors
+    query_embeddings = embedding_function(request.queries)
+
+    # Chunks are the only records with a chunk_index, so this skips book metadata
+    where_clause = {"$and": [{"user_id": user_id}, {"chunk_index": {"$gte": 0}}]}
+    if request.book_ids:
+        where_clause["$and"].append({"book_id": {"$in": request.book_ids}})
+    if rank_books:
+        n_results = SEARCH_MAX_CANDIDATES
+    overall = collection.query(query_embeddings=query_embeddings, where=where_clause, n_results=n_results, include=include)
+
+    book_records = collection.get(
+        ids=request.book_ids or None,
+        where={"$and": [{"type": "book_metadata"}, {"user_id": user_id}]},
+        include=["metadatas"]
+    )
+    books = dict(zip(book_records['ids'], book_records['metadatas']))
+
+    # One search per candidate book, so each gets its own top passages even when a
+    # single long book takes up most of the overall pool
+    per_book = {}
+    if rank_books:
+        for book_id in candidate_books(overall, request.max_books):
+            if book_id not in books:
+                continue
+            per_book[book_id] = collection.query(
+                query_embeddings=query_embeddings,
+                where={"$and": [{"user_id": user_id}, {"book_id": book_id}, {"chunk_index": {"$gte": 0}}]},
+                n_results=request.per_book,
+                include=include
+            )
+    return overall, books, per_book
+
+def search_hits(query: str, ids, documents, metadatas, distances, books: dict):
+    hits = []
+    for chunk_id, document, metadata, distance in zip(ids, documents, metadatas, distances):
+        book = books.get(metadata['book_id'], {})
+        chapter, section = chunk_labels(metadata, *book_outline(book))
+        hits.append(SearchHit(
+            chunk_id=chunk_id,
+            book_id=metadata['book_id'],
+            title=book.get('title', 'Unknown Title'),
+            chapter=chapter,
+            section=section,
+            chunk_index=metadata.get('chunk_index', 0),
+            distance=distance,
+            snippet=highlight_snippet(document, query)
+        ))
+    return hits
+
+@app.post("/search", response_model=SearchResponse)
+async def search(request: SearchRequest, current_user: DBUser = Depends(get_current_active_user)):
+    user_id = str(current_user.id)
+    offset = decode_cursor(request.cursor)
+    if offset >= SEARCH_MAX_CANDIDATES:
+        raise HTTPException(status_code=400, detail="Cursor is past the end of the results")
+    # One extra result tells us whether there is another page
+    n_results = min(SEARCH_MAX_CANDIDATES, offset + request.limit + 1)
+
+    release = await admit(search_admission, user_id)
+    try:
+        overall, books, per_book = await run_in_threadpool(run_search, request, user_id, n_results, offset == 0)
+    finally:
+        release()
+
+    query_results = []
+    has_more = False
+    for q, query in enumerate(request.queries):
+        hits = search_hits(
+            query, overall['ids'][q], overall['documents'][q], overall['metadatas'][q], overall['distances'][q], books
         )
-        async for chunk in stream:  # This should work now
-            if chunk.get("choices") and chunk["choices"][0].get("delta"):
-                content = chunk["choices"][0]["delta"].get("content")
-                if content is not None:
-                    yield f"data: {content}\n\n"
-        yield "data: [DONE]\n\n"
-
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+        book_rankings = None
+        if offset == 0:
+            book_rankings = []
+            for book_id, results in per_book.items():
+                book_hits = search_hits(
+                    query, results['ids'][q], results['documents'][q], results['metadatas'][q], results['distances'][q], books
+                )
+                if book_hits:
+                    book_rankings.append(BookHits(
+                        book_id=book_id,
+                        title=books[book_id].get('title', 'Unknown Title'),
+                        creator=books[book_id].get('creator', 'Unknown Author'),
+                        cover_url=books[book_id].get('cover_url', '/covers/default.jpg'),
+                        best_distance=book_hits[0].distance,
+                        passages=book_hits
+                    ))
+            book_rankings.sort(key=lambda book: book.best_distance)
+            book_rankings = book_rankings[:request.max_books]
+
+        query_results.append(QueryResults(
+            query=query,
+            books=book_rankings,
+            passages=hits[offset:offset + request.limit]
+        ))
+        has_more = has_more or len(hits) > offset + request.limit
+
+    next_offset = offset + request.limit
+    next_cursor = encode_cursor(next_offset) if has_more and next_offset < SEARCH_MAX_CANDIDATES else None
+    return SearchResponse(results=query_results, next_cursor=next_cursor)
+
+@app.get("/snapshot/export")
+async def export_library_snapshot(
+    current_user: DBUser = Depends(get_current_active_user),
+    user_id: Optional[str] = Query(None, description="User ID to export (admin only)"),
+    full: bool = Query(False, description="Export every user's library (admin only)")
+):
+    if (full or (user_id and user_id != str(current_user.id))) and not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Not authorized to export other users' libraries")
+    export_user_id = None if full else (user_id or str(current_user.id))
+
+    # Built on disk and streamed from there, so large libraries never sit in memory
+    fd, snapshot_path = tempfile.mkstemp(suffix=".tar", prefix="snapshot_")
+    os.close(fd)
+    try:
+        await run_in_threadpool(export_snapshot, collection, snapshot_path, export_user_id)
+    except ValueError as e:
+        os.remove(snapshot_path)
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception:
+        os.remove(snapshot_path)
+        raise
+
+    filename = f"library-{export_user_id or 'all'}-{datetime.utcnow():%Y%m%d%H%M%S}.tar"
+    return FileResponse(
+        snapshot_path,
+        media_type="application/x-tar",
+        filename=filename,
+        background=BackgroundTask(os.remove, snapshot_path)
+    )
+
+@app.post("/snapshot/restore")
+async def restore_library_snapshot(
+    file: UploadFile = File(...),
+    user_map: Optional[str] = Form(None),  # JSON object: {"<snapshot user id>": "<local user id>"}
+    new_ids: bool = Form(False),
+    current_user: DBUser = Depends(get_current_active_user)
+):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Only admins can restore snapshots")
+    try:
+        user_map = json.loads(user_map) if user_map else None
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="user_map must be a JSON object")
+    if user_map is not None and not isinstance(user_map, dict):
+        raise HTTPException(status_code=400, detail="user_map must be a JSON object")
+
+    fd, snapshot_path = tempfile.mkstemp(suffix=".tar", prefix="restore_")
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            await run_in_threadpool(shutil.copyfileobj, file.file, buffer)
+        result = await run_in_threadpool(restore_snapshot, collection, snapshot_path, user_map, new_ids)
+    except SnapshotConflict as e:
+        raise HTTPException(status_code=409, detail={"message": "Snapshot users conflict with local accounts", "conflicts": e.conflicts})
+    except PartialRestore as e:
+        raise HTTPException(status_code=500, detail={
+            "message": f"Partial restore: {str(e)}",
+            "user_ids": e.user_ids,
+            "records_restored": e.records_restored
+        })
+    except (ValueError, KeyError, tarfile.TarError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid snapshot: {str(e)}")
+    finally:
+        os.remove(snapshot_path)
+    return {"message": "Snapshot restored successfully", "result": result}
 
 # Serve static files from the 'covers' directory
 covers_dir = os.path.join(os.path.dirname(__file__), "covers")
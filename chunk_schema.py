@@ -0,0 +1,37 @@
+import json
+
+# Chunks only carry what `where` filters and ordering need. Everything describing the
+# book (title, creator, chapter and section names, total_chunks) lives once on the
+# book_metadata record and is joined in by the reader.
+CHUNK_METADATA_KEYS = ("user_id", "book_id", "chunk_index", "chapter_index", "section_index")
+
+
+def chunk_metadata(user_id, book_id, chunk_index, chapter_index, section_index):
+    """Metadata for one chunk; chapter_index and section_index are 1-based, 0 means none."""
+    return {
+        "user_id": user_id,
+        "book_id": book_id,
+        "chunk_index": chunk_index,
+        "chapter_index": chapter_index,
+        "section_index": section_index,
+    }
+
+
+def book_outline(book_metadata):
+    """Return the (chapters, sections) name lists stored on a book_metadata record."""
+    return (
+        json.loads(book_metadata.get("chapters", "[]")),
+        json.loads(book_metadata.get("sections", "[]")),
+    )
+
+
+def chunk_labels(metadata, chapters, sections):
+    """Return the (chapter, section) names of a chunk, joined from the book outline.
+
+    Falls back to the strings stored on chunks that have not been compacted yet.
+    """
+    chapter_index = metadata.get("chapter_index", 0)
+    section_index = metadata.get("section_index", 0)
+    chapter = chapters[chapter_index - 1] if 0 < chapter_index <= len(chapters) else metadata.get("chapter", "")
+    section = sections[section_index - 1] if 0 < section_index <= len(sections) else metadata.get("section", "")
+    return chapter, section
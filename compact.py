@@ -0,0 +1,115 @@
+import argparse
+import chromadb
+import json
+import os
+import sqlite3
+from chunk_schema import CHUNK_METADATA_KEYS, book_outline, chunk_metadata
+
+# Setting the environment
+CHROMA_PATH = os.path.join("chroma_db")
+BATCH_SIZE = 500
+
+# Initialize ChromaDB client
+chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
+collection = chroma_client.get_or_create_collection(name="books")
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def compact_book(book_id, book_metadata, dry_run=False):
+    """Rewrite one book's chunks to the compact schema. Returns the number of chunks changed."""
+    results = collection.get(where={"book_id": book_id}, include=["metadatas"])
+    chunks = sorted(
+        ((id, metadata) for id, metadata in zip(results['ids'], results['metadatas']) if id != book_id),
+        key=lambda chunk: chunk[1].get('chunk_index', 0)
+    )
+    chapters, sections = book_outline(book_metadata)
+
+    ids, metadatas = [], []
+    for id, metadata in chunks:
+        if set(metadata) == set(CHUNK_METADATA_KEYS):
+            continue
+
+        # Move chapter and section names onto the book record, keeping only their index
+        chapter_index = metadata.get('chapter_index', 0)
+        chapter = metadata.get('chapter')
+        if chapter and chapter_index > len(chapters):
+            chapters.extend([""] * (chapter_index - len(chapters)))
+            chapters[chapter_index - 1] = chapter
+        section = metadata.get('section')
+        if section and section not in sections:
+            sections.append(section)
+        section_index = metadata.get('section_index', sections.index(section) + 1 if section else 0)
+
+        # Setting a key to None removes it from the record
+        update = {key: None for key in metadata if key not in CHUNK_METADATA_KEYS}
+        update.update(chunk_metadata(
+            metadata['user_id'], book_id, metadata.get('chunk_index', 0), chapter_index, section_index
+        ))
+        ids.append(id)
+        metadatas.append(update)
+
+    if dry_run or (not ids and "sections" in book_metadata and "total_chunks" in book_metadata):
+        return len(ids)
+
+    for i in range(0, len(ids), BATCH_SIZE):
+        collection.update(ids=ids[i:i+BATCH_SIZE], metadatas=metadatas[i:i+BATCH_SIZE])
+
+    collection.update(ids=[book_id], metadatas=[{
+        "chapters": json.dumps(chapters),
+        "sections": json.dumps(sections),
+        "total_chapters": len(chapters),
+        "total_chunks": len(chunks)
+    }])
+    return len(ids)
+
+
+def vacuum():
+    """Give the space freed by the smaller metadata tables back to the filesystem."""
+    connection = sqlite3.connect(os.path.join(CHROMA_PATH, "chroma.sqlite3"))
+    try:
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+
+def compact(dry_run=False):
+    size_before = directory_size(CHROMA_PATH)
+
+    books = collection.get(where={"type": "book_metadata"}, include=["metadatas"])
+    changed = 0
+    for book_id, book_metadata in zip(books['ids'], books['metadatas']):
+        book_changed = compact_book(book_id, book_metadata, dry_run)
+        if book_changed:
+            print(f"{book_metadata.get('title', book_id)}: {book_changed} chunks {'to compact' if dry_run else 'compacted'}")
+        changed += book_changed
+
+    if dry_run:
+        print(f"Dry run: {changed} chunks would be compacted")
+        return
+
+    vacuum()
+    size_after = directory_size(CHROMA_PATH)
+    print(f"Compacted {changed} chunks across {len(books['ids'])} books")
+    print(f"Store size: {format_size(size_before)} -> {format_size(size_after)} "
+          f"(reclaimed {format_size(size_before - size_after)})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate chunk metadata to the compact schema and reclaim space.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report how many chunks would change")
+    args = parser.parse_args()
+    compact(args.dry_run)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed. `status_code` and `retry_after` map onto the HTTP response."""
+
+    def __init__(self, message, status_code=503, retry_after=5):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Caps concurrent work globally and per user, and queues the rest fairly.
+
+    Waiting requests are kept in one FIFO queue per user and admitted round-robin
+    across users, so a user with many queued requests cannot starve the others.
+    When the queues are full, or a request has waited longer than `max_wait`
+    seconds, it is shed with `Overloaded` instead of piling up latency.
+    """
+
+    def __init__(self, name, max_concurrent, max_per_user, max_queue, max_queue_per_user, max_wait, retry_after):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+
+        self.active = 0
+        self.active_by_user = {}
+        self.queues = OrderedDict()  # user_id -> deque of waiter futures, in round-robin order
+        self.queued = 0
+
+    def _can_run(self, user_id):
+        return self.active < self.max_concurrent and self.active_by_user.get(user_id, 0) < self.max_per_user
+
+    def _admit(self, user_id):
+        self.active += 1
+        self.active_by_user[user_id] = self.active_by_user.get(user_id, 0) + 1
+
+    def _has_runnable_waiter(self):
+        return any(self._can_run(user_id) for user_id in self.queues)
+
+    async def acquire(self, user_id):
+        if self._can_run(user_id) and not self._has_runnable_waiter():
+            self._admit(user_id)
+            return
+
+        if self.queued >= self.max_queue:
+            raise Overloaded(f"{self.name} is at capacity, try again later", 503, self.retry_after)
+        if len(self.queues.get(user_id, ())) >= self.max_queue_per_user:
+            raise Overloaded(f"Too many concurrent {self.name} requests", 429, self.retry_after)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user_id, deque()).append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # Admitted just as we gave up; hand the slot back
+                self.release(user_id)
+            else:
+                waiter.cancel()
+                self._remove_waiter(user_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                logger.warning(f"{self.name}: shed request from user {user_id} after waiting {self.max_wait}s")
+                raise Overloaded(f"{self.name} is at capacity, try again later", 503, self.retry_after)
+            raise
+
+    def _remove_waiter(self, user_id, waiter):
+        queue = self.queues.get(user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.queued -= 1
+            if not queue:
+                del self.queues[user_id]
+
+    def release(self, user_id):
+        self.active -= 1
+        self.active_by_user[user_id] -= 1
+        if not self.active_by_user[user_id]:
+            del self.active_by_user[user_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.max_concurrent:
+            user_id = next((u for u in self.queues if self.active_by_user.get(u, 0) < self.max_per_user), None)
+            if user_id is None:
+                return
+            queue = self.queues[user_id]
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                # Served: go to the back of the round-robin order
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            self._admit(user_id)
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+
+class SingleFlight:
+    """Coalesces identical in-flight calls: concurrent callers with the same key share one result."""
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            logger.debug(f"Coalesced in-flight call for {key}")
+        # Shield so one caller disconnecting does not cancel the call for the others
+        return await asyncio.shield(task)
@@ -0,0 +1,326 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+from sqlalchemy.exc import IntegrityError
+
+from database import SessionLocal, User
+
+logger = logging.getLogger(__name__)
+
+# A snapshot is an uncompressed tar holding:
+#   manifest.json     format version, counts, embedding shape and dtype
+#   users.jsonl       rows from users.db
+#   records.jsonl     one Chroma record (id, document, metadata) per line
+#   embeddings.f32    raw little-endian float32 matrix, row i belongs to records.jsonl line i
+#   covers/<file>     cover images of the exported books
+# The tar must stay uncompressed so embeddings.f32 can be memory-mapped straight out of it.
+SNAPSHOT_VERSION = 1
+EMBEDDING_DTYPE = np.dtype("<f4")
+BATCH_SIZE = 500
+COVERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "covers")
+
+USER_COLUMNS = ("id", "username", "email", "full_name", "hashed_password", "disabled", "is_admin")
+
+
+def export_snapshot(collection, output_path, user_id=None):
+    """Write a snapshot of one user (`user_id`) or of the whole library to `output_path`.
+
+    Records are paged out of Chroma in batches and written to disk as they arrive,
+    so memory use does not grow with the size of the library.
+    """
+    work_dir = tempfile.mkdtemp(prefix="snapshot_")
+    try:
+        db = SessionLocal()
+        try:
+            query = db.query(User)
+            if user_id is not None:
+                query = query.filter(User.id == int(user_id))
+            users = [{column: getattr(user, column) for column in USER_COLUMNS} for user in query]
+        finally:
+            db.close()
+        if user_id is not None and not users:
+            raise ValueError(f"User {user_id} not found")
+
+        with open(os.path.join(work_dir, "users.jsonl"), "w") as users_file:
+            for user in users:
+                users_file.write(json.dumps(user) + "\n")
+
+        where = {"user_id": str(user_id)} if user_id is not None else None
+        count, dimension, covers = 0, 0, []
+        with open(os.path.join(work_dir, "records.jsonl"), "w") as records_file, \
+                open(os.path.join(work_dir, "embeddings.f32"), "wb") as embeddings_file:
+            while True:
+                batch = collection.get(
+                    where=where,
+                    limit=BATCH_SIZE,
+                    offset=count,
+                    include=["documents", "metadatas", "embeddings"]
+                )
+                if not batch['ids']:
+                    break
+
+                embeddings = np.asarray(batch['embeddings'], dtype=EMBEDDING_DTYPE)
+                if dimension and embeddings.shape[1] != dimension:
+                    raise ValueError("Collection contains embeddings of different dimensions")
+                dimension = embeddings.shape[1]
+                embeddings_file.write(embeddings.tobytes())
+
+                for id, document, metadata in zip(batch['ids'], batch['documents'], batch['metadatas']):
+                    records_file.write(json.dumps({"id": id, "document": document, "metadata": metadata}) + "\n")
+                    if metadata.get("type") == "book_metadata":
+                        cover_file = os.path.basename(metadata.get("cover_url", ""))
+                        if cover_file and cover_file != "default.jpg":
+                            covers.append(cover_file)
+                count += len(batch['ids'])
+
+        manifest = {
+            "version": SNAPSHOT_VERSION,
+            "created_at": datetime.utcnow().isoformat(),
+            "user_id": str(user_id) if user_id is not None else None,
+            "users": len(users),
+            "records": count,
+            "embedding_dimension": dimension,
+            "embedding_dtype": EMBEDDING_DTYPE.str,
+        }
+        with open(os.path.join(work_dir, "manifest.json"), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+        # tarfile copies each member from disk in blocks
+        with tarfile.open(output_path, "w") as tar:
+            for name in ("manifest.json", "users.jsonl", "records.jsonl", "embeddings.f32"):
+                tar.add(os.path.join(work_dir, name), arcname=name)
+            for cover_file in covers:
+                cover_path = os.path.join(COVERS_DIR, cover_file)
+                if os.path.exists(cover_path):
+                    tar.add(cover_path, arcname=f"covers/{cover_file}")
+
+        logger.info(f"Exported {count} records and {len(users)} users to {output_path}")
+        return manifest
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class SnapshotConflict(ValueError):
+    """Raised when snapshot users collide with local accounts; `conflicts` lists each collision."""
+
+    def __init__(self, conflicts):
+        super().__init__("Snapshot users conflict with local accounts: " + "; ".join(conflicts))
+        self.conflicts = conflicts
+
+
+class PartialRestore(Exception):
+    """Raised when a restore fails after writing has started; users.db and the collection hold part of the snapshot."""
+
+    def __init__(self, message, user_ids, records_restored):
+        super().__init__(message)
+        self.user_ids = user_ids
+        self.records_restored = records_restored
+
+
+def collection_dimension(collection):
+    """Embedding dimension of the records already in `collection`, or None when it is empty."""
+    sample = collection.get(limit=1, include=["embeddings"])
+    return len(sample['embeddings'][0]) if sample['ids'] else None
+
+
+def restore_users(users, user_map=None, new_ids=False):
+    """Insert the snapshot's users. Returns a mapping of snapshot user ids to local ids.
+
+    Every user is checked against users.db on id, username and email before anything
+    is written. A user that matches one local row on all three is the same account;
+    one that matches nothing is inserted with its own id. Anything else is a conflict
+    and the restore is refused, unless `user_map` ({snapshot id: local id}) attaches
+    that user to an existing account, or `new_ids` is set and only the id is taken,
+    in which case the user is inserted under a new id. All inserts share one transaction.
+    """
+    user_map = {str(key): str(value) for key, value in (user_map or {}).items()}
+    user_ids, new_users, conflicts = {}, [], []
+    db = SessionLocal()
+    try:
+        for row in users:
+            snapshot_id = str(row["id"])
+            if snapshot_id in user_map:
+                local = db.query(User).filter(User.id == int(user_map[snapshot_id])).first()
+                if local is None:
+                    conflicts.append(f"user {snapshot_id} is mapped to local user {user_map[snapshot_id]}, which does not exist")
+                else:
+                    user_ids[snapshot_id] = str(local.id)
+                continue
+
+            by_id = db.query(User).filter(User.id == row["id"]).first()
+            by_username = db.query(User).filter(User.username == row["username"]).first()
+            by_email = db.query(User).filter(User.email == row["email"]).first() if row.get("email") else None
+            if by_id is not None and by_id.username == row["username"] and by_id.email == row.get("email"):
+                user_ids[snapshot_id] = str(by_id.id)
+                continue
+
+            if by_username is not None:
+                conflicts.append(f"user {snapshot_id}: username '{row['username']}' belongs to local user {by_username.id}")
+            elif by_email is not None:
+                conflicts.append(f"user {snapshot_id}: email '{row['email']}' belongs to local user {by_email.id}")
+            elif by_id is not None and not new_ids:
+                conflicts.append(f"user {snapshot_id}: id is taken by local user '{by_id.username}'")
+            else:
+                values = dict(row)
+                if by_id is not None:
+                    del values["id"]
+                new_users.append((snapshot_id, User(**values)))
+
+        if conflicts:
+            raise SnapshotConflict(conflicts)
+
+        db.add_all([user for _, user in new_users])
+        try:
+            db.flush()
+            for snapshot_id, user in new_users:
+                user_ids[snapshot_id] = str(user.id)
+            db.commit()
+        except IntegrityError as e:
+            db.rollback()
+            raise SnapshotConflict([f"users.db rejected the snapshot users: {e.orig}"])
+    finally:
+        db.close()
+    return user_ids
+
+
+def rename_book(record_id, metadata, book_ids):
+    """Move a record onto a fresh book_id, recorded in `book_ids`. Returns the new record id."""
+    old_book_id = metadata["book_id"]
+    new_book_id = book_ids.setdefault(old_book_id, str(uuid.uuid4()))
+    metadata["book_id"] = new_book_id
+    if metadata.get("cover_url") == f"/covers/{old_book_id}.jpg":
+        metadata["cover_url"] = f"/covers/{new_book_id}.jpg"
+    # Book records are keyed by book_id, chunks by f"{book_id}_chunk_{j}"
+    if record_id.startswith(old_book_id):
+        return new_book_id + record_id[len(old_book_id):]
+    return f"{new_book_id}_{record_id}"
+
+
+def restore_snapshot(collection, snapshot_path, user_map=None, new_ids=False):
+    """Load a snapshot into `collection` and users.db without re-embedding anything.
+
+    `user_map` and `new_ids` resolve user conflicts, see restore_users. Books of a
+    user who lands on a different local id get fresh book ids (and cover files),
+    so restoring a library onto another account copies it instead of taking over
+    the original records.
+
+    The archive, the embedding dimension and the users are checked before anything
+    is written (ValueError / SnapshotConflict). A failure after that raises
+    PartialRestore, which reports the users written and how many records made it.
+    """
+    # "r:" refuses compressed archives, whose member offsets could not be memory-mapped
+    with tarfile.open(snapshot_path, "r:") as tar:
+        manifest = json.load(tar.extractfile("manifest.json"))
+        if manifest.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {manifest.get('version')}")
+
+        count, dimension = manifest["records"], manifest["embedding_dimension"]
+        if count:
+            member = tar.getmember("embeddings.f32")
+            dtype = np.dtype(manifest["embedding_dtype"])
+            if member.size != count * dimension * dtype.itemsize:
+                raise ValueError(
+                    f"embeddings.f32 holds {member.size} bytes, expected {count} x {dimension} x {dtype.itemsize}"
+                )
+            existing_dimension = collection_dimension(collection)
+            if existing_dimension is not None and existing_dimension != dimension:
+                raise ValueError(
+                    f"Snapshot embeddings have {dimension} dimensions, the collection uses {existing_dimension}"
+                )
+
+        # Nothing is written until the archive and its users have been checked
+        users = [json.loads(line) for line in tar.extractfile("users.jsonl")]
+        user_ids = restore_users(users, user_map, new_ids)
+
+        remapped_users = {snapshot_id for snapshot_id, local_id in user_ids.items() if snapshot_id != local_id}
+        book_ids = {}  # Snapshot book_id -> fresh book_id, for books of remapped users
+        restored = 0
+        try:
+            if count:
+                # Map the embeddings directly from inside the tar; only touched pages are read
+                embeddings = np.memmap(
+                    snapshot_path, dtype=dtype, mode="r", offset=member.offset_data, shape=(count, dimension)
+                )
+
+                records = tar.extractfile("records.jsonl")
+                for start in range(0, count, BATCH_SIZE):
+                    batch = [json.loads(records.readline()) for _ in range(min(BATCH_SIZE, count - start))]
+                    ids, metadatas = [], []
+                    for record in batch:
+                        record_id, metadata = record["id"], record["metadata"]
+                        snapshot_user_id = metadata.get("user_id")
+                        if snapshot_user_id in user_ids:
+                            metadata["user_id"] = user_ids[snapshot_user_id]
+                        if snapshot_user_id in remapped_users and metadata.get("book_id"):
+                            record_id = rename_book(record_id, metadata, book_ids)
+                        ids.append(record_id)
+                        metadatas.append(metadata)
+                    collection.upsert(
+                        ids=ids,
+                        embeddings=embeddings[start:start + len(batch)].tolist(),
+                        documents=[record["document"] for record in batch],
+                        metadatas=metadatas
+                    )
+                    restored += len(batch)
+
+            os.makedirs(COVERS_DIR, exist_ok=True)
+            for member in tar.getmembers():
+                if member.isfile() and member.name.startswith("covers/"):
+                    cover_file = os.path.basename(member.name)
+                    book_id, extension = os.path.splitext(cover_file)
+                    if book_id in book_ids:
+                        cover_file = book_ids[book_id] + extension
+                    with tar.extractfile(member) as source, \
+                            open(os.path.join(COVERS_DIR, cover_file), "wb") as target:
+                        shutil.copyfileobj(source, target)
+        except Exception as e:
+            logger.error(f"Restore of {snapshot_path} stopped after {restored} of {count} records: {str(e)}")
+            raise PartialRestore(
+                f"Restore stopped after {restored} of {count} records: {str(e)}", user_ids, restored
+            ) from e
+
+    logger.info(f"Restored {count} records and {len(users)} users from {snapshot_path}")
+    return {"records": count, "users": len(users), "user_ids": user_ids, "book_ids": book_ids}
+
+
+if __name__ == "__main__":
+    import chromadb
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Export or restore a snapshot of the library.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Write a snapshot")
+    export_parser.add_argument("path", help="Snapshot file to write (.tar)")
+    export_parser.add_argument("--user-id", help="Only export this user (id from users.db)")
+    restore_parser = subparsers.add_parser("restore", help="Load a snapshot")
+    restore_parser.add_argument("path", help="Snapshot file to read")
+    restore_parser.add_argument("--map", action="append", default=[], metavar="SNAPSHOT_ID=LOCAL_ID",
+                                help="Attach a snapshot user to an existing local user (repeatable)")
+    restore_parser.add_argument("--new-ids", action="store_true",
+                                help="Give new users whose id is taken locally a fresh id")
+    args = parser.parse_args()
+
+    # Setting the environment
+    chroma_client = chromadb.PersistentClient(path=os.path.join("chroma_db"))
+    collection = chroma_client.get_or_create_collection(name="books")
+
+    if args.command == "export":
+        print(json.dumps(export_snapshot(collection, args.path, args.user_id), indent=2))
+    else:
+        user_map = dict(mapping.split("=", 1) for mapping in args.map)
+        try:
+            result = restore_snapshot(collection, args.path, user_map, args.new_ids)
+        except SnapshotConflict as e:
+            parser.exit(1, "Restore refused:\n" + "\n".join(f"  {conflict}" for conflict in e.conflicts) + "\n")
+        except PartialRestore as e:
+            parser.exit(1, f"Partial restore: {str(e)}\n")
+        print(f"Restored {result['records']} records and {result['users']} users")
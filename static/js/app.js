@@ -126,23 +126,8 @@ async function uploadFile(file) {
         return;
     }
 
-    const formData = new FormData();
-    formData.append('file', file);
-
     try {
-        const response = await fetch(`/upload`, {
-            method: 'POST',
-            headers: {
-                'Authorization': `Bearer ${accessToken}`,
-            },
-            body: formData,
-        });
-
-        if (!response.ok) {
-            throw new Error('Failed to upload file');
-        }
-
-        const result = await response.json();
+        const result = await uploadInChunks(file);
         console.log('Upload successful:', result);
         
         // Refresh the book list after upload
@@ -152,6 +137,82 @@ async function uploadFile(file) {
     }
 }
 
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+// Resumable upload: the file is sent in chunks and a dropped chunk is retried
+// from the offset the server reports, instead of starting over. Once every byte
+// has arrived the server ingests the book in the background and we poll for it.
+async function uploadInChunks(file, maxRetries = 5) {
+    const headers = { 'Authorization': `Bearer ${accessToken}` };
+
+    const sessionResponse = await fetch('/upload/sessions', {
+        method: 'POST',
+        headers: { ...headers, 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, total_size: file.size }),
+    });
+    if (!sessionResponse.ok) {
+        throw new Error('Failed to start upload');
+    }
+    let status = await sessionResponse.json();
+    const uploadId = status.upload_id;
+
+    const fetchStatus = async () => {
+        const response = await fetch(`/upload/sessions/${uploadId}`, { headers });
+        if (!response.ok) {
+            throw Object.assign(new Error('Upload session lost'), { fatal: true });
+        }
+        return response.json();
+    };
+
+    let retries = 0;
+    const retryOrThrow = async (error, delaySeconds) => {
+        if (error.fatal || ++retries > maxRetries) {
+            throw error;
+        }
+        await sleep(1000 * (delaySeconds || retries));
+    };
+
+    while (status.state === 'receiving') {
+        const chunk = file.slice(status.offset, status.offset + status.chunk_size);
+        try {
+            const response = await fetch(`/upload/sessions/${uploadId}`, {
+                method: 'PUT',
+                headers: { ...headers, 'Upload-Offset': String(status.offset) },
+                body: chunk,
+            });
+            if (response.status === 409 || response.status === 429 || response.status === 503) {
+                // Out of sync or server busy: back off, then ask where to resume
+                await retryOrThrow(new Error('Upload kept being refused'), parseInt(response.headers.get('Retry-After'), 10));
+                status = await fetchStatus();
+                continue;
+            }
+            if (!response.ok) {
+                const error = await response.json();
+                throw Object.assign(new Error(error.detail || 'Failed to upload file'), { fatal: true });
+            }
+            status = await response.json();
+            retries = 0;
+        } catch (error) {
+            // Connection dropped: ask the server how far it got and resume from there
+            await retryOrThrow(error);
+            status = await fetchStatus();
+        }
+    }
+
+    while (status.state === 'processing') {
+        await sleep(2000);
+        try {
+            status = await fetchStatus();
+        } catch (error) {
+            await retryOrThrow(error);
+        }
+    }
+    if (status.state === 'failed') {
+        throw new Error(status.error || 'Failed to process book');
+    }
+    return status;
+}
+
 async function fetchBooks() {
     console.log('Fetching books for user:', currentUserId);
     try {
@@ -1,13 +1,21 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Request, Header, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import Optional
 import os
 import uuid
-import shutil
+import asyncio
 import logging
 import zipfile
 import xml.etree.ElementTree as ET
-from bs4 import BeautifulSoup
+import posixpath
+import re
+import json
+from urllib.parse import unquote
+from bs4 import BeautifulSoup, NavigableString
 import chromadb
 from PIL import Image
 import io
@@ -15,6 +23,17 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 import html
 import concurrent.futures
 from itertools import chain
+from dotenv import load_dotenv
+from jose import JWTError, jwt
+from database import User as DBUser, SessionLocal
+from chunk_schema import chunk_metadata
+from upload_sessions import (
+    UploadError, MAX_CHUNK_SIZE, create_session, get_session, close_session, sweep_temp_dir
+)
+from scheduler import AdmissionController, Overloaded
+
+# Load environment variables
+load_dotenv()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -40,6 +59,43 @@ collection = chroma_client.get_or_create_collection(name="books")
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Admission control for upload requests, which hold a slot for their whole request
+upload_admission = AdmissionController(
+    "upload",
+    max_concurrent=int(os.getenv("UPLOAD_MAX_CONCURRENT", 8)),
+    max_per_user=int(os.getenv("UPLOAD_MAX_PER_USER", 2)),
+    max_queue=int(os.getenv("UPLOAD_MAX_QUEUE", 32)),
+    max_queue_per_user=int(os.getenv("UPLOAD_MAX_QUEUE_PER_USER", 2)),
+    max_wait=float(os.getenv("UPLOAD_MAX_WAIT", 30)),
+    retry_after=int(os.getenv("UPLOAD_RETRY_AFTER", 10)),
+)
+
+# Security configurations (must match api.py)
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = "HS256"
+
+async def get_current_user(token: str):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id: str = payload.get("sub")
+        if user_id is None:
+            raise credentials_exception
+    except JWTError:
+        raise credentials_exception
+    db = SessionLocal()
+    try:
+        user = db.query(DBUser).filter(DBUser.id == user_id).first()
+    finally:
+        db.close()
+    if user is None or user.disabled:
+        raise credentials_exception
+    return user
+
 def extract_cover_image(zip_ref, opf_content, book_id):
     try:
         root = ET.fromstring(opf_content)
@@ -87,23 +143,154 @@ def extract_cover_image(zip_ref, opf_content, book_id):
         logger.error(f"Error extracting cover image: {str(e)}")
         return None
 
+CONTENT_MEDIA_TYPES = ("application/xhtml+xml", "text/html")
+SECTION_MARKER = "\u0000SECTION{}\u0000"
+
+def resolve_href(base_file, href):
+    """Resolve an href relative to the file it appears in to a zip member path and fragment."""
+    path, _, fragment = unquote(href).partition('#')
+    if path:
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(base_file), path))
+    else:
+        path = base_file
+    return path, fragment or None
+
+def read_ncx_toc(zip_ref, ncx_file):
+    ns = {'ncx': 'http://www.daisy.org/z3986/2005/ncx/'}
+    root = ET.fromstring(zip_ref.read(ncx_file))
+    entries = []
+
+    def walk(nav_point, depth):
+        label = nav_point.find('ncx:navLabel/ncx:text', ns)
+        content = nav_point.find('ncx:content', ns)
+        if content is not None and content.get('src'):
+            path, fragment = resolve_href(ncx_file, content.get('src'))
+            label_text = (label.text or '').strip() if label is not None else ''
+            entries.append((depth, label_text, path, fragment))
+        for child in nav_point.findall('ncx:navPoint', ns):
+            walk(child, depth + 1)
+
+    nav_map = root.find('ncx:navMap', ns)
+    if nav_map is not None:
+        for nav_point in nav_map.findall('ncx:navPoint', ns):
+            walk(nav_point, 0)
+    return entries
+
+def read_nav_toc(zip_ref, nav_file):
+    soup = BeautifulSoup(zip_ref.read(nav_file).decode('utf-8'), 'html.parser')
+    nav = soup.find('nav', attrs={'epub:type': 'toc'}) or soup.find('nav')
+    entries = []
+
+    def walk(ol, depth):
+        for li in ol.find_all('li', recursive=False):
+            link = li.find('a', recursive=False)
+            if link is not None and link.get('href'):
+                path, fragment = resolve_href(nav_file, link.get('href'))
+                entries.append((depth, link.get_text(' ', strip=True), path, fragment))
+            child = li.find('ol', recursive=False)
+            if child is not None:
+                walk(child, depth + 1)
+
+    if nav is not None and nav.find('ol') is not None:
+        walk(nav.find('ol'), 0)
+    return entries
+
+def read_toc(zip_ref, content_root, opf_file, ns):
+    """Return the table of contents as (depth, label, path, fragment) tuples in TOC order."""
+    try:
+        nav_item = content_root.find(".//opf:manifest/opf:item[@properties='nav']", ns)
+        if nav_item is not None:
+            entries = read_nav_toc(zip_ref, resolve_href(opf_file, nav_item.get('href'))[0])
+            if entries:
+                return entries
+
+        spine = content_root.find('.//opf:spine', ns)
+        ncx_id = spine.get('toc') if spine is not None else None
+        ncx_item = content_root.find(f".//opf:manifest/opf:item[@id='{ncx_id}']", ns) if ncx_id else None
+        if ncx_item is None:
+            ncx_item = content_root.find(".//opf:manifest/opf:item[@media-type='application/x-dtbncx+xml']", ns)
+        if ncx_item is not None:
+            return read_ncx_toc(zip_ref, resolve_href(opf_file, ncx_item.get('href'))[0])
+    except Exception as e:
+        logger.warning(f"Could not read table of contents: {str(e)}")
+    return []
+
+def plan_spine(content_root, opf_file, toc, ns):
+    """Assign chapter and section labels to the spine documents, in reading order.
+
+    Top-level TOC entries start a chapter, deeper entries start a section. Documents
+    without a TOC entry continue the chapter before them; anything before the first
+    entry is chapter 0. Without a TOC every spine document is its own chapter.
+    Returns (documents, chapters) where each document is (path, start, boundaries).
+    """
+    manifest = {
+        item.get('id'): item for item in content_root.findall('.//opf:manifest/opf:item', ns)
+    }
+    spine_paths = []
+    for itemref in content_root.findall('.//opf:spine/opf:itemref', ns):
+        item = manifest.get(itemref.get('idref'))
+        if item is not None and item.get('media-type') in CONTENT_MEDIA_TYPES:
+            spine_paths.append(resolve_href(opf_file, item.get('href'))[0])
+
+    entries_by_path = {}
+    for depth, label, path, fragment in toc:
+        entries_by_path.setdefault(path, []).append((depth, label, fragment))
+
+    chapters = []
+    current = (0, "", "")
+    documents = []
+    for spine_index, path in enumerate(spine_paths):
+        entries = entries_by_path.get(path, [])
+        if not toc:
+            entries = [(0, f"Section {spine_index + 1}", None)]
+
+        start = current
+        boundaries = []
+        for depth, label, fragment in entries:
+            if depth == 0:
+                chapters.append(label)
+                current = (len(chapters), label, "")
+            else:
+                current = (current[0], current[1], label)
+            if fragment is None and not boundaries:
+                start = current
+            else:
+                boundaries.append((fragment, current))
+        documents.append((path, start, boundaries))
+    return documents, chapters
+
 def process_xhtml_item(args):
-    item, zip_ref, opf_file = args
-    html_path = item.get('href')
+    document, zip_ref = args
+    path, start, boundaries = document
     try:
-        full_path = os.path.join(os.path.dirname(opf_file), html_path)
-        html_content = zip_ref.read(full_path).decode('utf-8')
+        html_content = zip_ref.read(path).decode('utf-8')
         soup = BeautifulSoup(html_content, 'html.parser')
+
+        # Mark where each TOC anchor starts so sections can be split out of the text
+        labels = [start]
+        for fragment, label in boundaries:
+            anchor = soup.find(id=fragment) if fragment else None
+            if anchor is None:
+                # Anchor missing: the label still applies from here on
+                labels[-1] = label
+                continue
+            anchor.insert_before(NavigableString(SECTION_MARKER.format(len(labels))))
+            labels.append(label)
+
         text = soup.get_text(separator=' ', strip=True)
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=100,
             length_function=len,
         )
-        chunks = text_splitter.split_text(text)
-        return chunks
+        segments = re.split(SECTION_MARKER.format(r"(\d+)"), text)
+        # re.split alternates text and captured marker numbers: [text, n, text, n, text...]
+        results = [(labels[0], text_splitter.split_text(segments[0]))]
+        for number, segment in zip(segments[1::2], segments[2::2]):
+            results.append((labels[int(number)], text_splitter.split_text(segment)))
+        return results
     except Exception as e:
-        logger.error(f"Error processing file {html_path}: {str(e)}")
+        logger.error(f"Error processing file {path}: {str(e)}")
         return []
 
 def process_book(temp_file_path, user_id, book_id, filename):
@@ -136,18 +323,25 @@ def process_book(temp_file_path, user_id, book_id, filename):
             if not cover_url:
                 cover_url = "/covers/default.jpg"
 
-            xhtml_items = content_root.findall('.//opf:item[@media-type="application/xhtml+xml"]', ns)
-            logger.info(f"Found {len(xhtml_items)} XHTML items to process.")
+            toc = read_toc(zip_ref, content_root, opf_file, ns)
+            documents, chapters = plan_spine(content_root, opf_file, toc, ns)
+            logger.info(f"Found {len(documents)} spine documents and {len(chapters)} chapters to process.")
 
             # Prepare arguments for parallel processing
-            args_list = [(item, zip_ref, opf_file) for item in xhtml_items]
+            args_list = [(document, zip_ref) for document in documents]
 
-            # Process XHTML items in parallel
+            # Process spine documents in parallel; map() keeps them in reading order
             with concurrent.futures.ThreadPoolExecutor() as executor:
-                chunks_list = list(executor.map(process_xhtml_item, args_list))
-
-            # Flatten the list of chunks
-            all_chunks = list(chain.from_iterable(chunks_list))
+                segments_list = list(executor.map(process_xhtml_item, args_list))
+
+            # Flatten into reading order; section names are numbered in order of appearance
+            all_chunks = []
+            sections = []
+            for (chapter_index, chapter, section), chunks in chain.from_iterable(segments_list):
+                if section and section not in sections:
+                    sections.append(section)
+                section_index = sections.index(section) + 1 if section else 0
+                all_chunks.extend((chunk, chapter_index, section_index) for chunk in chunks)
             total_chunks = len(all_chunks)
 
             logger.info(f"Chunking complete. Total chunks: {total_chunks}")
@@ -165,7 +359,11 @@ def process_book(temp_file_path, user_id, book_id, filename):
                     "creator": creator,
                     "identifier": identifier,
                     "cover_url": cover_url,
-                    "description": description
+                    "description": description,
+                    "chapters": json.dumps(chapters),
+                    "sections": json.dumps(sections),
+                    "total_chapters": len(chapters),
+                    "total_chunks": total_chunks
                 }],
                 ids=[book_id]
             )
@@ -175,18 +373,14 @@ def process_book(temp_file_path, user_id, book_id, filename):
             for i in range(0, total_chunks, batch_size):
                 batch_chunks = all_chunks[i:i+batch_size]
                 batch_ids = [f"{book_id}_chunk_{j}" for j in range(i, i+len(batch_chunks))]
-                batch_metadatas = [{
-                    "type": "book_chunk",
-                    "user_id": user_id,
-                    "book_id": book_id,
-                    "title": title,
-                    "creator": creator,
-                    "chunk_index": j,
-                    "total_chunks": total_chunks
-                } for j in range(i, i+len(batch_chunks))]
+                # chunk_index is the chunk's position in reading order
+                batch_metadatas = [
+                    chunk_metadata(user_id, book_id, j, chapter_index, section_index)
+                    for j, (_, chapter_index, section_index) in enumerate(batch_chunks, start=i)
+                ]
 
                 collection.add(
-                    documents=batch_chunks,
+                    documents=[chunk[0] for chunk in batch_chunks],
                     metadatas=batch_metadatas,
                     ids=batch_ids
                 )
@@ -206,36 +400,175 @@ def process_book(temp_file_path, user_id, book_id, filename):
             os.remove(temp_file_path)
             logger.info(f"Removed temporary file: {temp_file_path}")
 
+@app.on_event("startup")
+async def remove_orphaned_uploads():
+    # Sessions do not survive a restart, so their partial files are useless
+    sweep_temp_dir()
+
+def overloaded_exception(e: Overloaded):
+    return HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...), token: str = Depends(oauth2_scheme)):
+    user = await get_current_user(token)
+    user_id = str(user.id)
     try:
-        # Validate the token and get the user (you'll need to implement this)
-        user = await get_current_user(token)
-        user_id = user.username
+        async with upload_admission.slot(user_id):
+            return await store_upload(file, user_id)
+    except Overloaded as e:
+        raise overloaded_exception(e)
+
+async def store_upload(file: UploadFile, user_id: str):
+    # Single-request upload: FastAPI has already spooled the whole multipart body,
+    # so this only reuses the session's size limits and validation. Clients that
+    # need early rejection or resume should use /upload/sessions.
+    file.file.seek(0, os.SEEK_END)
+    total_size = file.file.tell()
+    file.file.seek(0)
+
+    session = None
+    try:
+        session = create_session(user_id, file.filename, total_size)
+        while chunk := await file.read(MAX_CHUNK_SIZE):
+            session.write(chunk)
+        start_ingestion(session)
+        await run_ingestion(session)
+        return {"message": "File uploaded and processed successfully", "book_id": session.book_id, "sha256": session.sha256_digest, "result": session.result}
+    except UploadError as e:
+        logger.warning(f"Rejected upload {file.filename}: {str(e)}")
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing upload: {str(e)}")
+    finally:
+        if session is not None:
+            close_session(session)
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    total_size: int
+    checksum: Optional[str] = None  # Optional SHA-256 hex digest of the whole file
+
+# Ingestion runs outside the request, so it is bounded separately from upload_admission
+ingestion_slots = asyncio.Semaphore(int(os.getenv("INGEST_MAX_CONCURRENT", 2)))
+ingestion_tasks = set()
+
+def start_ingestion(session):
+    """Check a fully received upload and mark it as handed over to ingestion."""
+    digest = session.finish()
+    logger.info(f"Upload {session.upload_id} complete ({session.total_size} bytes, sha256 {digest})")
+    session.mark_processing(str(uuid.uuid4()), digest)
+
+async def run_ingestion(session):
+    """Store the book; the outcome is recorded on the session for status polling."""
+    try:
+        async with ingestion_slots:
+            result = await run_in_threadpool(
+                process_book, session.temp_file_path, session.user_id, session.book_id, session.filename
+            )
+    except Exception as e:
+        logger.error(f"Error processing upload: {str(e)}")
+        session.mark_failed(f"Error processing upload: {str(e)}")
+        raise
+    session.mark_done(result)
 
-        # Create a directory for temporary files if it doesn't exist
-        temp_dir = os.path.join(os.getcwd(), "temp_uploads")
-        os.makedirs(temp_dir, exist_ok=True)
+async def ingest_in_background(session):
+    try:
+        await run_ingestion(session)
+    except Exception:
+        pass  # Already recorded on the session
 
-        # Save the file with a unique name
-        file_extension = os.path.splitext(file.filename)[1]
-        temp_file_name = f"{uuid.uuid4()}{file_extension}"
-        temp_file_path = os.path.join(temp_dir, temp_file_name)
+def session_response(session):
+    # 202 while the book is still being ingested, so clients know to poll
+    return JSONResponse(status_code=202 if session.state == "processing" else 200, content=session.status())
 
-        with open(temp_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+@app.post("/upload/sessions")
+async def create_upload_session(request: UploadSessionCreate, token: str = Depends(oauth2_scheme)):
+    user = await get_current_user(token)
+    try:
+        session = create_session(str(user.id), request.filename, request.total_size, request.checksum)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    return session.status()
+
+@app.get("/upload/sessions/{upload_id}")
+async def get_upload_session(upload_id: str, token: str = Depends(oauth2_scheme)):
+    user = await get_current_user(token)
+    try:
+        session = get_session(upload_id, str(user.id))
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    # Clients resume from `offset` after a dropped connection, and poll here for ingestion
+    return session_response(session)
+
+@app.put("/upload/sessions/{upload_id}")
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., alias="Upload-Offset"),
+    token: str = Depends(oauth2_scheme)
+):
+    user = await get_current_user(token)
+    user_id = str(user.id)
+    try:
+        session = get_session(upload_id, user_id)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
 
-        logger.info(f"File saved temporarily at: {temp_file_path}")
+    try:
+        async with upload_admission.slot(user_id):
+            return await receive_chunk(session, request, upload_offset)
+    except Overloaded as e:
+        raise overloaded_exception(e)
+
+async def receive_chunk(session, request: Request, upload_offset: int):
+    if session.state != "receiving":
+        # Every byte already arrived (e.g. the final response was lost); report the outcome
+        return session_response(session)
+    if session.busy or upload_offset != session.offset:
+        # Client is out of sync (e.g. a retried chunk racing the original); tell it where to resume
+        raise HTTPException(
+            status_code=409,
+            detail=f"Expected offset {session.offset}",
+            headers={"Upload-Offset": str(session.offset)}
+        )
 
-        book_id = str(uuid.uuid4())
+    session.busy = True
+    try:
+        received = 0
+        async for data in request.stream():
+            received += len(data)
+            if received > MAX_CHUNK_SIZE:
+                raise UploadError(f"Chunk exceeds the maximum size of {MAX_CHUNK_SIZE} bytes", 413)
+            session.write(data)
+    except UploadError as e:
+        logger.warning(f"Rejected upload {session.upload_id}: {str(e)}")
+        if e.status_code != 413:
+            # Invalid content: drop the session rather than let the client keep sending
+            close_session(session)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception:
+        # Connection dropped mid-chunk; whatever was written stays and the client resumes from there
+        logger.info(f"Upload {session.upload_id} interrupted at offset {session.offset}")
+        raise
+    finally:
+        session.busy = False
 
-        # Process the book immediately
-        result = process_book(temp_file_path, user_id, book_id, file.filename)
+    if not session.complete:
+        return session.status()
 
-        return {"message": "File uploaded and processed successfully", "book_id": book_id, "result": result}
-    except Exception as e:
-        logger.error(f"Error processing upload: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing upload: {str(e)}")
+    try:
+        start_ingestion(session)
+    except UploadError as e:
+        logger.warning(f"Rejected upload {session.upload_id}: {str(e)}")
+        close_session(session)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    # Ingest in the background and answer 202 straight away; the session keeps the
+    # book_id and outcome until it expires, so a dropped connection loses nothing
+    task = asyncio.create_task(ingest_in_background(session))
+    ingestion_tasks.add(task)
+    task.add_done_callback(ingestion_tasks.discard)
+    return session_response(session)
 
 if __name__ == "__main__":
     import uvicorn
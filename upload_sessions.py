@@ -0,0 +1,320 @@
+import os
+import time
+import uuid
+import zlib
+import struct
+import hashlib
+import logging
+import zipfile
+import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+# Upload limits (override through the environment)
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 200 * 1024 * 1024))  # 200 MB per book
+MAX_CHUNK_SIZE = int(os.getenv("MAX_UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))  # 8 MB per request
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))  # Suggested client chunk size
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", 24 * 60 * 60))  # Abandoned sessions expire after a day
+COMPLETED_SESSION_TTL = int(os.getenv("COMPLETED_UPLOAD_TTL", 60 * 60))  # Finished uploads stay queryable for an hour
+MAX_SESSIONS_PER_USER = int(os.getenv("MAX_UPLOAD_SESSIONS_PER_USER", 4))  # Open uploads per user
+MAX_RESERVED_BYTES_PER_USER = int(os.getenv("MAX_UPLOAD_BYTES_PER_USER", 2 * MAX_UPLOAD_SIZE))  # Declared size of a user's open uploads
+MAX_OPF_SIZE = int(os.getenv("MAX_OPF_SIZE", 4 * 1024 * 1024))  # Largest OPF file we will buffer and parse
+MAX_MIMETYPE_SIZE = 1024  # The mimetype entry is 20 bytes; anything much larger is not an EPUB
+
+TEMP_DIR = os.path.join(os.getcwd(), "temp_uploads")
+
+EPUB_MIMETYPE = b"application/epub+zip"
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+LOCAL_HEADER_SIZE = 30
+OPF_NS = {'opf': 'http://www.idpf.org/2007/opf'}
+
+
+class UploadError(Exception):
+    """Raised when an upload is rejected. `status_code` maps onto the HTTP response."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class EpubStreamValidator:
+    """Walks the ZIP local file headers as bytes arrive so a bad EPUB is rejected early.
+
+    Checks that the stream starts with a ZIP local header, that a leading `mimetype`
+    entry says `application/epub+zip`, and parses the OPF as soon as its entry is
+    complete. The walk stops (without failing) at entries that use a data descriptor,
+    since their size is only known once the central directory arrives. Only the
+    mimetype and OPF entries are ever buffered, and both are size-capped.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.consumed = 0  # Absolute offset of buffer[0]
+        self.skip = 0  # Bytes of an uninteresting entry still to pass over
+        self.entries_seen = 0
+        self.walking = True
+        self.opf_validated = False
+
+    def feed(self, data):
+        if not self.walking:
+            return
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            self.consumed += skipped
+            data = data[skipped:]
+        self.buffer += data
+        while self.walking and self.buffer:
+            if len(self.buffer) < LOCAL_HEADER_SIZE:
+                if self.consumed == 0 and len(self.buffer) >= 4 and not self.buffer.startswith(LOCAL_HEADER_SIGNATURE):
+                    raise UploadError("File is not an EPUB (missing ZIP signature)", 415)
+                return
+
+            if not self.buffer.startswith(LOCAL_HEADER_SIGNATURE):
+                if self.consumed == 0:
+                    raise UploadError("File is not an EPUB (missing ZIP signature)", 415)
+                # Central directory (or something we don't understand) reached
+                self._stop()
+                return
+
+            (flags, method, compressed_size, name_length, extra_length) = struct.unpack(
+                "<6xHH8xI4xHH", self.buffer[:LOCAL_HEADER_SIZE]
+            )
+            if flags & 0x08 or compressed_size == 0xFFFFFFFF:
+                # Sizes live in a data descriptor or ZIP64 record; wait for the central directory
+                self._stop()
+                return
+
+            data_start = LOCAL_HEADER_SIZE + name_length + extra_length
+            if len(self.buffer) < data_start:
+                return
+            name = self.buffer[LOCAL_HEADER_SIZE:LOCAL_HEADER_SIZE + name_length].decode("utf-8", "replace")
+            entry_end = data_start + compressed_size
+
+            if self._wants(name):
+                self._check_size(name, compressed_size)
+                if len(self.buffer) < entry_end:
+                    return
+                self._check_entry(name, method, self.buffer[data_start:entry_end])
+            elif len(self.buffer) < entry_end:
+                # Pass over the rest of this entry without buffering it
+                self.skip = entry_end - len(self.buffer)
+                self.consumed += len(self.buffer)
+                self.buffer.clear()
+                self.entries_seen += 1
+                return
+
+            self.entries_seen += 1
+            self.consumed += entry_end
+            del self.buffer[:entry_end]
+
+    def _wants(self, name):
+        return (self.entries_seen == 0 and name == "mimetype") or (name.endswith(".opf") and not self.opf_validated)
+
+    def _check_size(self, name, size):
+        if self.entries_seen == 0 and name == "mimetype":
+            if size > MAX_MIMETYPE_SIZE:
+                raise UploadError("File is not an EPUB (unexpected mimetype entry)", 415)
+        elif size > MAX_OPF_SIZE:
+            raise UploadError(f"EPUB OPF file exceeds the maximum size of {MAX_OPF_SIZE} bytes", 422)
+
+    def _check_entry(self, name, method, payload):
+        if self.entries_seen == 0 and name == "mimetype":
+            if self._inflate(method, payload, MAX_MIMETYPE_SIZE).strip() != EPUB_MIMETYPE:
+                raise UploadError("File is not an EPUB (unexpected mimetype entry)", 415)
+        elif name.endswith(".opf") and not self.opf_validated:
+            validate_opf(self._inflate(method, payload, MAX_OPF_SIZE))
+            self.opf_validated = True
+            logger.info(f"OPF validated early: {name}")
+
+    def _inflate(self, method, payload, max_size):
+        if method == 0:
+            return bytes(payload)
+        if method == 8:
+            decompressor = zlib.decompressobj(-15)
+            try:
+                data = decompressor.decompress(payload, max_size + 1)
+            except zlib.error:
+                raise UploadError("EPUB contains a corrupt entry", 422)
+            if len(data) > max_size:
+                raise UploadError(f"EPUB entry inflates past the maximum size of {max_size} bytes", 422)
+            return data
+        raise UploadError(f"EPUB uses an unsupported compression method ({method})", 422)
+
+    def _stop(self):
+        self.walking = False
+        self.buffer = bytearray()
+
+
+def validate_opf(opf_content):
+    try:
+        root = ET.fromstring(opf_content)
+    except ET.ParseError as e:
+        raise UploadError(f"EPUB has a malformed OPF file: {str(e)}", 422)
+    if root.find('.//opf:manifest', OPF_NS) is None or root.find('.//opf:spine', OPF_NS) is None:
+        raise UploadError("EPUB OPF file has no manifest or spine", 422)
+
+
+def validate_epub_file(path):
+    """Validate the central directory and OPF of a fully received EPUB."""
+    try:
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            opf_file = next((f for f in zip_ref.namelist() if f.endswith('.opf')), None)
+            if not opf_file:
+                raise UploadError("No OPF file found in the EPUB", 422)
+            if zip_ref.getinfo(opf_file).file_size > MAX_OPF_SIZE:
+                raise UploadError(f"EPUB OPF file exceeds the maximum size of {MAX_OPF_SIZE} bytes", 422)
+            validate_opf(zip_ref.read(opf_file))
+    except zipfile.BadZipFile as e:
+        raise UploadError(f"EPUB is truncated or corrupt: {str(e)}", 422)
+
+
+class UploadSession:
+    """A resumable upload: chunks are appended at `offset` and hashed incrementally."""
+
+    def __init__(self, user_id, filename, total_size, checksum=None):
+        if total_size <= 0:
+            raise UploadError("Upload size must be greater than zero")
+        if total_size > MAX_UPLOAD_SIZE:
+            raise UploadError(f"Upload exceeds the maximum size of {MAX_UPLOAD_SIZE} bytes", 413)
+
+        self.upload_id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.filename = filename
+        self.total_size = total_size
+        self.checksum = checksum.lower() if checksum else None
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+        self.validator = EpubStreamValidator()
+        self.updated_at = time.time()
+        self.busy = False  # A chunk is being received
+        # receiving -> processing -> done | failed; the outcome is kept after ingestion
+        self.state = "receiving"
+        self.book_id = None
+        self.sha256_digest = None
+        self.result = None
+        self.error = None
+
+        os.makedirs(TEMP_DIR, exist_ok=True)
+        file_extension = os.path.splitext(filename)[1]
+        self.temp_file_path = os.path.join(TEMP_DIR, f"{self.upload_id}{file_extension}")
+        open(self.temp_file_path, "wb").close()
+
+    @property
+    def complete(self):
+        return self.offset == self.total_size
+
+    def write(self, data):
+        """Append a piece of the current chunk; the offset check is done by the caller."""
+        if self.offset + len(data) > self.total_size:
+            raise UploadError("Chunk extends past the declared upload size", 413)
+        self.validator.feed(data)
+        with open(self.temp_file_path, "ab") as buffer:
+            buffer.write(data)
+        self.sha256.update(data)
+        self.offset += len(data)
+        self.updated_at = time.time()
+
+    def finish(self):
+        """Check the digest and the full ZIP structure once the last byte has arrived."""
+        digest = self.sha256.hexdigest()
+        if self.checksum and self.checksum != digest:
+            raise UploadError("Checksum mismatch, upload corrupted in transit", 422)
+        validate_epub_file(self.temp_file_path)
+        return digest
+
+    @property
+    def is_open(self):
+        """Still holding (or about to hold) a temporary file."""
+        return self.state in ("receiving", "processing")
+
+    def mark_processing(self, book_id, digest):
+        self.state = "processing"
+        self.book_id = book_id
+        self.sha256_digest = digest
+        self.updated_at = time.time()
+
+    def mark_done(self, result):
+        self.state = "done"
+        self.result = result
+        self.updated_at = time.time()
+
+    def mark_failed(self, error):
+        self.state = "failed"
+        self.error = error
+        self.updated_at = time.time()
+
+    def status(self):
+        return {
+            "upload_id": self.upload_id,
+            "filename": self.filename,
+            "state": self.state,
+            "offset": self.offset,
+            "total_size": self.total_size,
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "max_chunk_size": MAX_CHUNK_SIZE,
+            "book_id": self.book_id,
+            "sha256": self.sha256_digest,
+            "result": self.result,
+            "error": self.error,
+        }
+
+    def discard(self):
+        if os.path.exists(self.temp_file_path):
+            os.remove(self.temp_file_path)
+            logger.info(f"Removed temporary file: {self.temp_file_path}")
+
+
+# In-flight uploads, keyed by upload_id. This lives in process memory: a server
+# restart forgets every session (see sweep_temp_dir), and with several workers a
+# resume only works when it reaches the worker that holds the session, so the
+# upload server must run as a single process.
+upload_sessions = {}
+
+
+def sweep_temp_dir():
+    """Remove partial uploads left behind by a previous process; call once at startup."""
+    if not os.path.isdir(TEMP_DIR):
+        return
+    for name in os.listdir(TEMP_DIR):
+        path = os.path.join(TEMP_DIR, name)
+        if os.path.isfile(path):
+            os.remove(path)
+            logger.info(f"Removed orphaned temporary file: {path}")
+
+
+def create_session(user_id, filename, total_size, checksum=None):
+    expire_sessions()
+    open_sessions = [s for s in upload_sessions.values() if s.user_id == user_id and s.is_open]
+    if len(open_sessions) >= MAX_SESSIONS_PER_USER:
+        raise UploadError(f"Too many open uploads (maximum {MAX_SESSIONS_PER_USER})", 429)
+    if sum(s.total_size for s in open_sessions) + total_size > MAX_RESERVED_BYTES_PER_USER:
+        raise UploadError(f"Open uploads exceed the maximum of {MAX_RESERVED_BYTES_PER_USER} bytes per user", 413)
+
+    session = UploadSession(user_id, filename, total_size, checksum)
+    upload_sessions[session.upload_id] = session
+    logger.info(f"Created upload session {session.upload_id} for {filename} ({total_size} bytes)")
+    return session
+
+
+def get_session(upload_id, user_id):
+    expire_sessions()
+    session = upload_sessions.get(upload_id)
+    if session is None or session.user_id != user_id:
+        raise UploadError("Upload session not found", 404)
+    return session
+
+
+def close_session(session):
+    upload_sessions.pop(session.upload_id, None)
+    session.discard()
+
+
+def expire_sessions():
+    now = time.time()
+    for session in list(upload_sessions.values()):
+        if session.state == "receiving" and not session.busy and session.updated_at < now - UPLOAD_SESSION_TTL:
+            logger.info(f"Expiring abandoned upload session {session.upload_id}")
+            close_session(session)
+        elif session.state in ("done", "failed") and session.updated_at < now - COMPLETED_SESSION_TTL:
+            close_session(session)